@@ -11,7 +11,7 @@ import random
 import matplotlib.pyplot as plt
 from spinalcordtoolbox.image import Image
 from scipy.ndimage.measurements import label
-from scipy.ndimage.morphology import binary_dilation, binary_fill_holes, binary_closing
+from scipy.ndimage.morphology import binary_fill_holes, binary_closing, distance_transform_cdt
 
 
 def save_sample(img, fname_out):
@@ -27,30 +27,18 @@ def save_sample(img, fname_out):
 
 
 def dilate_mask(mask, nb_dilation_it=3):
-    # values of the voxels added to the input mask
-    soft_label_values = [x / (nb_dilation_it+1) for x in range(nb_dilation_it, 0, -1)]
-
-    # dilation
-    mask_bin, mask_soft = mask.astype(np.int), mask.astype(np.float)
-    for soft_label in soft_label_values:
-        # binary dilation with 1 iteration
-        mask_dilated = binary_dilation(mask_bin, iterations=1)
-
-        # isolate new voxels, i.e. the ones from the dilation
-        new_voxels = np.logical_xor(mask_dilated, mask_bin).astype(np.int)
-
-        # assign a soft value (]0, 1[) to the new voxels
-        soft_new_voxels = soft_label * new_voxels
-
-        # add the new voxels to the input mask
-        mask_soft += soft_new_voxels
-        mask_bin = (mask_soft > 0).astype(np.int)
+    # soft value (]0, 1[) decreasing with the taxicab distance to the mask: the voxels at
+    # distance k are exactly the k-th 1-iteration dilation shell, so one distance transform
+    # replaces the nb_dilation_it sequential binary_dilation calls
+    dist = distance_transform_cdt(mask == 0, metric='taxicab')
+    mask_soft = np.clip(1.0 - dist / (nb_dilation_it + 1.0), 0.0, 1.0)
+    mask_bin = (mask_soft > 0).astype(np.int)
 
     # save the mask after dilation, used later during post-processing
     mask_after_dilation = np.copy(mask_soft)
 
     # coordinates of the new voxels, i.e. the ones from the dilation
-    new_voxels_xx, new_voxels_yy = np.where(np.logical_xor(mask_bin, mask))
+    new_voxels_xx, new_voxels_yy = np.where(mask_bin != mask)
     nb_new_voxels = new_voxels_xx.shape[0]
 
     # ratio of voxels added to the input mask from the dilated mask
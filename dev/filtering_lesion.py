@@ -12,7 +12,11 @@ import argparse
 import pandas as pd
 import numpy as np
 import nibabel as nib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
+from functools import lru_cache
+from itertools import islice
 # from sklearn.metrics import auc
 import matplotlib.pyplot as plt
 from scipy.ndimage import label, generate_binary_structure
@@ -43,6 +47,42 @@ exp_dct = {
 }
 
 
+@lru_cache(maxsize=32)
+def load_nii(fname):
+    # float32 instead of the float64 copy made by the deprecated get_data();
+    # the lru_cache avoids re-decoding volumes used by several experiments
+    return np.asarray(nib.load(fname).dataobj, dtype=np.float32)
+
+
+def mean_pred(fnames):
+    # average the MC samples with a running in-place sum rather than stacking all of them
+    # into one K x volume array before reducing
+    data_soft = None
+    for fname in fnames:
+        pred = load_nii(fname)
+        if data_soft is None:
+            # copy, so the running sum does not corrupt the lru_cached array
+            data_soft = pred.astype(np.float32)
+        else:
+            data_soft += pred
+    if data_soft is not None:
+        data_soft /= len(fnames)
+    return data_soft
+
+
+def prefetch_map(executor, fn, iterable, n_prefetch):
+    # ordered executor.map, but with at most n_prefetch tasks in flight: map submits the
+    # whole cohort up front and buffers every completed volume, so peak memory would grow
+    # with the dataset instead of with the prefetch window
+    items = iter(iterable)
+    futures = deque(executor.submit(fn, item) for item in islice(items, n_prefetch))
+    while futures:
+        future = futures.popleft()
+        for item in islice(items, 1):
+            futures.append(executor.submit(fn, item))
+        yield future.result()
+
+
 def get_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("-c", help="Config file path.")
@@ -69,10 +109,8 @@ def print_unc_stats(unc_name, pred_folder, im_lst):
     mins, p25s, p50s, p75s, maxs = [], [], [], [], []
     for fname_pref in im_lst:
         fname_unc = os.path.join(pred_folder, fname_pref + unc_name + '.nii.gz')
-        im = nib.load(fname_unc)
-        data_unc = im.get_data()
-        del im
-        vals = list(data_unc[data_unc > 0])
+        data_unc = load_nii(fname_unc)
+        vals = data_unc[data_unc > 0]
         if len(vals):
             mins.append(np.min(vals))
             maxs.append(np.max(vals))
@@ -105,28 +143,38 @@ def run_experiment(level, unc_name, thr_unc_lst, thr_pred_lst, gt_folder, pred_f
                'retained_elt': [[] for _ in range(len(thr_unc_lst))]
                }
 
-    # loop across images
-    for fname_pref in im_lst:
+    # pred_masks folder content is invariant in this loop: list it once
+    pred_files = os.listdir(pred_folder)
+
+    def load_image(fname_pref):
         # uncertainty map
         fname_unc = os.path.join(pred_folder, fname_pref + unc_name + '.nii.gz')
-        im = nib.load(fname_unc)
-        data_unc = im.get_data()
-        del im
+        data_unc = load_nii(fname_unc)
 
-        # list MC samples
-        data_pred_lst = np.array([nib.load(os.path.join(pred_folder, f)).get_data()
-                                  for f in os.listdir(pred_folder) if fname_pref + '_pred_' in f])
+        # soft prediction, averaged over the MC samples
+        data_soft = mean_pred([os.path.join(pred_folder, f)
+                               for f in pred_files if fname_pref + '_pred_' in f])
 
         # ground-truth fname
         fname_gt = os.path.join(gt_folder, fname_pref.split('_')[0], 'anat', fname_pref + target_suf + '.nii.gz')
         if os.path.isfile(fname_gt):
             nib_gt = nib.load(fname_gt)
-            data_gt = nib_gt.get_data()
+            data_gt = np.asarray(nib_gt.dataobj, dtype=np.float32)
+        else:
+            nib_gt, data_gt = None, None
+        return data_unc, data_soft, nib_gt, data_gt
+
+    # loop across images; the thread pool loads and decompresses the volumes of the next
+    # images while the metrics of the current one are being computed
+    n_workers = min(8, os.cpu_count())
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        for data_unc, data_soft, nib_gt, data_gt in prefetch_map(executor, load_image, im_lst,
+                                                                 n_prefetch=2 * n_workers):
+            if nib_gt is None:
+                continue
             print(np.sum(data_gt))
-            # soft prediction
-            data_soft = np.mean(data_pred_lst, axis=0)
 
-            if np.any(data_soft):
+            if data_soft is not None and np.any(data_soft):
                 for i_unc, thr_unc in enumerate(thr_unc_lst):
                     # discard uncertain lesions from data_soft
                     data_soft_thrUnc = deepcopy(data_soft)
@@ -194,48 +242,54 @@ def run_inference(pred_folder, im_lst, thr_pred, gt_folder, target_suf, param_ev
     # init df
     df_results = pd.DataFrame()
 
-    # loop across images
-    for fname_pref in im_lst:
-        if not any(elem is None for elem in [unc_name, thr_unc]):
+    # pred_masks folder content is invariant in this loop: list it once
+    pred_files = os.listdir(pred_folder)
+    use_unc = not any(elem is None for elem in [unc_name, thr_unc])
+
+    def load_image(fname_pref):
+        if use_unc:
             print(thr_unc)
             # uncertainty map
             fname_unc = os.path.join(pred_folder, fname_pref + unc_name + '.nii.gz')
-            im = nib.load(fname_unc)
-            data_unc = im.get_data()
-            del im
+            data_unc = load_nii(fname_unc)
 
-            # list MC samples
-            data_pred_lst = np.array([nib.load(os.path.join(pred_folder, f)).get_data()
-                                      for f in os.listdir(pred_folder) if fname_pref + '_pred_' in f])
+            # soft prediction, averaged over the MC samples
+            data_soft = mean_pred([os.path.join(pred_folder, f)
+                                   for f in pred_files if fname_pref + '_pred_' in f])
         else:
-            data_pred_lst = np.array([nib.load(os.path.join(pred_folder, f)).get_data()
-                                      for f in os.listdir(pred_folder) if fname_pref + '_pred.' in f])
+            data_unc = None
+            data_soft = mean_pred([os.path.join(pred_folder, f)
+                                   for f in pred_files if fname_pref + '_pred.' in f])
 
         # ground-truth fname
         fname_gt = os.path.join(gt_folder, fname_pref.split('_')[0], 'anat', fname_pref + target_suf + '.nii.gz')
         nib_gt = nib.load(fname_gt)
-        data_gt = nib_gt.get_data()
-
-        # soft prediction
-        data_soft = np.mean(data_pred_lst, axis=0)
-
-        if not any(elem is None for elem in [unc_name, thr_unc]):
-            print('thr')
-            # discard uncertain lesions from data_soft
-            data_soft[data_unc > thr_unc] = 0
-
-        data_hard = imed_postpro.threshold_predictions(data_soft, thr=thr_pred).astype(np.uint8)
-
-        eval = imed_utils.Evaluation3DMetrics(data_pred=data_hard,
-                                              data_gt=data_gt,
-                                              dim_lst=nib_gt.header['pixdim'][1:4],
-                                              params=param_eval)
-
-        results_pred, _ = eval.run_eval()
-
-        # save results of this fname_pred
-        results_pred['image_id'] = fname_pref.split('_')[0]
-        df_results = df_results.append(results_pred, ignore_index=True)
+        data_gt = np.asarray(nib_gt.dataobj, dtype=np.float32)
+        return data_unc, data_soft, nib_gt, data_gt
+
+    # loop across images; the thread pool loads and decompresses the volumes of the next
+    # images while the metrics of the current one are being computed
+    n_workers = min(8, os.cpu_count())
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        for fname_pref, (data_unc, data_soft, nib_gt, data_gt) in \
+                zip(im_lst, prefetch_map(executor, load_image, im_lst, n_prefetch=2 * n_workers)):
+            if use_unc:
+                print('thr')
+                # discard uncertain lesions from data_soft
+                data_soft[data_unc > thr_unc] = 0
+
+            data_hard = imed_postpro.threshold_predictions(data_soft, thr=thr_pred).astype(np.uint8)
+
+            eval = imed_utils.Evaluation3DMetrics(data_pred=data_hard,
+                                                  data_gt=data_gt,
+                                                  dim_lst=nib_gt.header['pixdim'][1:4],
+                                                  params=param_eval)
+
+            results_pred, _ = eval.run_eval()
+
+            # save results of this fname_pred
+            results_pred['image_id'] = fname_pref.split('_')[0]
+            df_results = df_results.append(results_pred, ignore_index=True)
 
     return df_results
 
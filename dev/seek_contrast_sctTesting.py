@@ -15,13 +15,17 @@ def run_main():
         print('\nThis folder does not exist: {}'.format(PATH_SCTTESTING))
         print('Please change the path at the top of this file')
 
-    subj_lst = [os.path.join(PATH_SCTTESTING, s, 'anat') for s in os.listdir(PATH_SCTTESTING) if
-                os.path.isdir(os.path.join(PATH_SCTTESTING, s, 'anat'))]
+    # os.scandir enumerates and stats the entries in a single pass, instead of a listdir
+    # followed by one isdir stat per subject
+    with os.scandir(PATH_SCTTESTING) as entries:
+        subj_lst = [os.path.join(entry.path, 'anat') for entry in entries
+                    if entry.is_dir() and os.path.isdir(os.path.join(entry.path, 'anat'))]
     print('\n{} subjects found.\n'.format(str(len(subj_lst))))
 
     contrast_lst_lst = []
     for subj_fold in tqdm(subj_lst, desc="Scanning dataset"):
-        img_lst = [i for i in os.listdir(subj_fold) if i.endswith('.nii.gz')]
+        with os.scandir(subj_fold) as entries:
+            img_lst = [entry.name for entry in entries if entry.name.endswith('.nii.gz')]
         contrast_cur_lst = ['_'.join(c.split('.nii.gz')[0].split('_')[1:]) for c in img_lst]
         contrast_lst_lst.append(contrast_cur_lst)
 
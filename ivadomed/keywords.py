@@ -1,8 +1,5 @@
-from dataclasses import dataclass
-
-
-@dataclass
 class ConfigKW:
+    __slots__ = ()
     LOADER_PARAMETERS = "loader_parameters"
     TRAINING_PARAMETERS = "training_parameters"
     MODEL_NAME = "model_name"
@@ -26,8 +23,8 @@ class ConfigKW:
     TRAINING_SHA256 = "training_sha256"
 
 
-@dataclass
 class LoaderParamsKW:
+    __slots__ = ()
     PATH_DATA = "path_data"
     BIDS_CONFIG = "bids_config"
     TARGET_SUFFIX = "target_suffix"
@@ -44,8 +41,8 @@ class LoaderParamsKW:
     SLICE_FILTER_PARAMS = "slice_filter_params"
 
 
-@dataclass
 class SplitDatasetKW:
+    __slots__ = ()
     SPLIT_METHOD = "split_method"
     FNAME_SPLIT = "fname_split"
     DATA_TESTING = "data_testing"
@@ -55,41 +52,41 @@ class SplitDatasetKW:
     BALANCE = "balance"
 
 
-@dataclass
 class DataTestingKW:
+    __slots__ = ()
     DATA_TYPE = "data_type"
     DATA_VALUE = "data_value"
 
 
-@dataclass
 class TrainingParamsKW:
+    __slots__ = ()
     BALANCE_SAMPLES = "balance_samples"
     BATCH_SIZE = "batch_size"
 
 
-@dataclass
 class TransformationKW:
+    __slots__ = ()
     ROICROP = "ROICrop"
     CENTERCROP = "CenterCrop"
     RESAMPLE = "Resample"
 
 
-@dataclass
 class BalanceSamplesKW:
+    __slots__ = ()
     APPLIED = "applied"
     TYPE = "type"
 
 
-@dataclass
 class ContrastParamsKW:
+    __slots__ = ()
     CONTRAST_LST = "contrast_lst"  # The list help determine the number of model parameter inputs.
     BALANCE = "balance"
     TRAINING_VALIDATION = "training_validation"
     TESTING = "testing"
 
 
-@dataclass
 class ModelParamsKW:
+    __slots__ = ()
     LENGTH_2D = "length_2D"
     STRIDE_2D = "stride_2D"
     LENGTH_3D = "length_3D"
@@ -115,8 +112,8 @@ class ModelParamsKW:
     MISSING_PROBABILITY_GROWTH = "missing_probability_growth"
 
 
-@dataclass
 class SubjectDictKW:
+    __slots__ = ()
     ABSOLUTE_PATHS = "absolute_paths"
     DERIV_PATH = "deriv_path"
     ROI_FILENAME = "roi_filename"
@@ -124,13 +121,13 @@ class SubjectDictKW:
     EXTENSIONS = "extensions"
 
 
-@dataclass
 class SubjectDataFrameKW:
+    __slots__ = ()
     FILENAME = "filename"
 
 
-@dataclass
 class BidsDataFrameKW:
+    __slots__ = ()
     # bids layout converted to dataframe during bids dataset creation
     PATH = "path"   # full path.
     FILENAME = "filename"  # the actual file's name (base)
@@ -142,53 +139,53 @@ class BidsDataFrameKW:
     DERIVATIVES = "derivatives"
 
 
-@dataclass
 class ROIParamsKW:
+    __slots__ = ()
     SUFFIX = "suffix"
     SLICE_FILTER_ROI = "slice_filter_roi"
 
 
-@dataclass
 class MetadataParamsKW:
+    __slots__ = ()
     CONTRAST = "contrast"
     BOUNDING_BOX = "bounding_box"
 
 
-@dataclass
 class MetadataChoiceKW:
+    __slots__ = ()
     MRI_PARAMS = "mri_params"
     CONTRASTS = "contrasts"
 
 
-@dataclass
 class ObjectDetectionParamsKW:
+    __slots__ = ()
     GPU_IDS = "gpu_ids"
     PATH_OUTPUT = "path_output"
     OBJECT_DETECTION_PATH = "object_detection_path"
     SAFETY_FACTOR = "safety_factor"
 
 
-@dataclass
 class UncertaintyKW:
+    __slots__ = ()
     ALEATORIC = 'aleatoric'
     N_IT = "n_it"
 
 
-@dataclass
 class PostprocessingKW:
+    __slots__ = ()
     BINARIZE_PREDICTION = "binarize_prediction"
 
 
-@dataclass
 class BinarizeProdictionKW:
+    __slots__ = ()
     THR = "thr"
 
 
-@dataclass
 class SliceFilterParamsKW:
+    __slots__ = ()
     FILTER_EMPTY_MASK = "filter_empty_mask"
 
 
-@dataclass
 class IgnoredFolderKW:
+    __slots__ = ()
     MACOSX = "__MACOSX"
\ No newline at end of file
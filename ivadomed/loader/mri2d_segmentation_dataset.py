@@ -2,16 +2,57 @@ import copy
 import random
 
 import numpy as np
+from loguru import logger
 import torch
 from torch.utils.data import Dataset
 
-from ivadomed import transforms as imed_transforms, postprocessing as imed_postpro
+from ivadomed import transforms as imed_transforms
 from ivadomed.loader import utils as imed_loader_utils
 from ivadomed.loader.utils import dropout_input
 from ivadomed.loader.segmentation_pair import SegmentationPair
 from ivadomed.object_detection import utils as imed_obj_detect
 from ivadomed.keywords import ROIParamsKW
 
+# Patch coordinates are stored in a structured array rather than a list of dicts: 20 bytes
+# per patch instead of a few hundred, which matters when the indexes are replicated in every
+# DataLoader worker
+_PATCH_INDEX_DTYPE = np.dtype([('x_min', 'i4'), ('x_max', 'i4'),
+                               ('y_min', 'i4'), ('y_max', 'i4'),
+                               ('handler_index', 'i4')])
+
+
+def _memo_arrays(sample, memo):
+    """Pre-seed a deepcopy memo so the (possibly nested) arrays of a sample stay shared."""
+    if isinstance(sample, np.ndarray):
+        memo[id(sample)] = sample
+    elif isinstance(sample, list):
+        for element in sample:
+            _memo_arrays(element, memo)
+
+
+def _copy_pair_slices(item):
+    """Copy a (seg_pair_slice, roi_pair_slice) item without duplicating the image arrays.
+
+    ``copy.deepcopy`` on a handler recursively copies the input, gt and roi arrays, which
+    dominates the ``__getitem__`` time. Transforms never modify their input arrays in place
+    (they return new arrays), so only the containers and the metadata, which are rewritten at
+    each iteration (transforms params, rater picking), actually need to be copied. The arrays
+    are kept shared by pre-seeding the deepcopy memo with them.
+
+    Args:
+        item (tuple): Pair of dict (seg_pair_slice, roi_pair_slice), as stored in
+            ``self.handlers`` or ``self.indexes``.
+
+    Returns:
+        tuple: Copy of the pair, with the metadata deep-copied and the arrays shared.
+    """
+    memo = {}
+    for pair in item:
+        if pair is not None:
+            _memo_arrays(pair.get('input'), memo)
+            _memo_arrays(pair.get('gt'), memo)
+    return copy.deepcopy(item, memo)
+
 
 class MRI2DSegmentationDataset(Dataset):
     """Generic class for 2D (slice-wise) segmentation dataset.
@@ -34,7 +75,8 @@ class MRI2DSegmentationDataset(Dataset):
         is_input_dropout (bool): Return input with missing modalities.
 
     Attributes:
-        indexes (list): List of indices corresponding to each slice or patch in the dataset.
+        indexes (list or np.ndarray): List of loaded slices (no patching), or structured array of
+            patch coordinates (2d patching).
         handlers (list): List of indices corresponding to each slice in the dataset, used for indexing patches.
         filename_pairs (list): List of tuples in the format (input filename list containing all modalities,ground \
             truth filename, ROI filename, metadata).
@@ -85,6 +127,8 @@ class MRI2DSegmentationDataset(Dataset):
         self.has_bounding_box = True
         self.task = task
         self.is_input_dropout = is_input_dropout
+        self._labels = None
+        self._shared_input = None
 
 
     def load_filenames(self):
@@ -100,20 +144,27 @@ class MRI2DSegmentationDataset(Dataset):
             input_data_shape, _ = seg_pair.get_pair_shapes()
 
             for idx_pair_slice in range(input_data_shape[-1]):
-                slice_seg_pair = seg_pair.get_pair_slice(idx_pair_slice, gt_type=self.task)
-                self.has_bounding_box = imed_obj_detect.verify_metadata(slice_seg_pair, self.has_bounding_box)
+                # Run the ROI filter first when it is active, so that rejected slices skip the
+                # segmentation slice build and the transforms adjustment entirely
+                # Note: we force here gt_type=segmentation since ROI slice is needed to Crop the image
+                if self.slice_filter_roi:
+                    slice_roi_pair = roi_pair.get_pair_slice(idx_pair_slice, gt_type="segmentation")
+                    if imed_loader_utils.filter_roi(slice_roi_pair['gt'], self.roi_thr):
+                        continue
 
-                if self.has_bounding_box:
-                    self.prepro_transforms = imed_obj_detect.adjust_transforms(self.prepro_transforms, slice_seg_pair)
+                slice_seg_pair = seg_pair.get_pair_slice(idx_pair_slice, gt_type=self.task)
 
                 if self.slice_filter_fn and not self.slice_filter_fn(slice_seg_pair):
                     continue
 
-                # Note: we force here gt_type=segmentation since ROI slice is needed to Crop the image
-                slice_roi_pair = roi_pair.get_pair_slice(idx_pair_slice, gt_type="segmentation")
+                # Bounding box check and transforms adjustment only matter for retained slices
+                self.has_bounding_box = imed_obj_detect.verify_metadata(slice_seg_pair, self.has_bounding_box)
 
-                if self.slice_filter_roi and imed_loader_utils.filter_roi(slice_roi_pair['gt'], self.roi_thr):
-                    continue
+                if self.has_bounding_box:
+                    self.prepro_transforms = imed_obj_detect.adjust_transforms(self.prepro_transforms, slice_seg_pair)
+
+                if not self.slice_filter_roi:
+                    slice_roi_pair = roi_pair.get_pair_slice(idx_pair_slice, gt_type="segmentation")
 
                 item = imed_transforms.apply_preprocessing_transforms(self.prepro_transforms,
                                                                       slice_seg_pair,
@@ -131,9 +182,61 @@ class MRI2DSegmentationDataset(Dataset):
         # If is_2d_patch, prepare indices of patches
         if self.is_2d_patch:
             self.prepare_indices()
+        # For classification, the labels are scalars: gather them once into an int8 tensor so
+        # __getitem__ only indexes into it instead of allocating a tensor per sample
+        elif self.task != "segmentation" and \
+                all(seg['gt'] and np.ndim(seg['gt'][0]) == 0 for seg, _ in self.indexes):
+            self._labels = torch.as_tensor([int(seg['gt'][0]) for seg, _ in self.indexes],
+                                           dtype=torch.int8)
+
+        # Coalesce the preprocessed input arrays into one shared-memory tensor so DataLoader
+        # workers map a single physical copy instead of each duplicating the dataset
+        self._share_input_arrays()
+
+    def _share_input_arrays(self):
+        """Move the input arrays of the loaded slices into a single shared-memory tensor.
+
+        The slices (or handlers) each hold per-contrast float32 arrays; they are copied once into
+        one flat ``torch`` tensor backed by shared memory and replaced by numpy views into it.
+        Aliasing is preserved: seg and roi pairs pointing to the same array end up viewing the
+        same region of the tensor. When shared memory cannot hold the dataset (e.g. docker's
+        default 64 MB ``/dev/shm``), the slices keep their private arrays instead.
+        """
+        items = self.handlers if self.is_2d_patch else self.indexes
+        arrays = {}
+        for item in items:
+            for pair in item:
+                if pair is not None and pair.get('input'):
+                    for arr in pair['input']:
+                        arrays.setdefault(id(arr), arr)
+        if not arrays:
+            return
+
+        try:
+            shared = torch.empty(sum(arr.size for arr in arrays.values()), dtype=torch.float32)
+            shared.share_memory_()
+        except (RuntimeError, OSError):
+            logger.warning("Could not allocate shared memory for the loaded slices, "
+                           "keeping one copy of the dataset per worker.")
+            return
+        flat = shared.numpy()
+
+        views = {}
+        offset = 0
+        for key, arr in arrays.items():
+            flat[offset:offset + arr.size] = arr.ravel()
+            views[key] = flat[offset:offset + arr.size].reshape(arr.shape)
+            offset += arr.size
+
+        for item in items:
+            for pair in item:
+                if pair is not None and pair.get('input'):
+                    pair['input'] = [views[id(arr)] for arr in pair['input']]
+        self._shared_input = shared
 
     def prepare_indices(self):
-        """Stores coordinates of 2d patches for training."""
+        """Stores coordinates of 2d patches for training, as a structured array."""
+        coords_per_handler = []
         for i in range(0, len(self.handlers)):
 
             input_img = self.handlers[i][0]['input']
@@ -147,18 +250,24 @@ class MRI2DSegmentationDataset(Dataset):
                 if length > size:
                     raise RuntimeError('"length_2D" must be smaller or equal to image dimensions after resampling.')
 
-            for x in range(0, (shape[0] - self.length[0] + self.stride[0]), self.stride[0]):
-                if x + self.length[0] > shape[0]:
-                    x = (shape[0] - self.length[0])
-                for y in range(0, (shape[1] - self.length[1] + self.stride[1]), self.stride[1]):
-                    if y + self.length[1] > shape[1]:
-                        y = (shape[1] - self.length[1])
-                    self.indexes.append({
-                        'x_min': x,
-                        'x_max': x + self.length[0],
-                        'y_min': y,
-                        'y_max': y + self.length[1],
-                        'handler_index': i})
+            # Compute all the patch coordinates of the handler at once; the last start position
+            # along each axis is clamped so that the patch fits within the image
+            xs = np.arange(0, shape[0] - self.length[0] + self.stride[0], self.stride[0])
+            xs[-1] = min(xs[-1], shape[0] - self.length[0])
+            ys = np.arange(0, shape[1] - self.length[1] + self.stride[1], self.stride[1])
+            ys[-1] = min(ys[-1], shape[1] - self.length[1])
+            xx, yy = np.meshgrid(xs, ys, indexing='ij')
+
+            coords = np.empty(xx.size, dtype=_PATCH_INDEX_DTYPE)
+            coords['x_min'] = xx.ravel()
+            coords['x_max'] = coords['x_min'] + self.length[0]
+            coords['y_min'] = yy.ravel()
+            coords['y_max'] = coords['y_min'] + self.length[1]
+            coords['handler_index'] = i
+            coords_per_handler.append(coords)
+
+        self.indexes = np.concatenate(coords_per_handler) if coords_per_handler \
+            else np.empty(0, dtype=_PATCH_INDEX_DTYPE)
 
     def set_transform(self, transform):
         self.transform = transform
@@ -173,24 +282,23 @@ class MRI2DSegmentationDataset(Dataset):
             index (int): Slice index.
         """
 
-        # copy.deepcopy is used to have different coordinates for reconstruction for a given handler with patch,
+        # The pair is copied to have different coordinates for reconstruction for a given handler with patch,
         # to allow a different rater at each iteration of training, and to clean transforms params from previous
-        # transforms i.e. remove params from previous iterations so that the coming transforms are different
+        # transforms i.e. remove params from previous iterations so that the coming transforms are different.
+        # Only the containers and metadata are copied, the underlying arrays are shared (see _copy_pair_slices)
         if self.is_2d_patch:
             coord = self.indexes[index]
-            seg_pair_slice, roi_pair_slice = copy.deepcopy(self.handlers[coord['handler_index']])
+            seg_pair_slice, roi_pair_slice = _copy_pair_slices(self.handlers[int(coord['handler_index'])])
         else:
-            seg_pair_slice, roi_pair_slice = copy.deepcopy(self.indexes[index])
+            seg_pair_slice, roi_pair_slice = _copy_pair_slices(self.indexes[index])
 
-        # In case multiple raters
+        # In case multiple raters: randomly pick a rater and use it as ground truth for this
+        # iteration. Note: in case of multi-class: the same rater is used across classes
         if seg_pair_slice['gt'] and isinstance(seg_pair_slice['gt'][0], list):
-            # Randomly pick a rater
-            idx_rater = random.randint(0, len(seg_pair_slice['gt'][0]) - 1)
-            # Use it as ground truth for this iteration
-            # Note: in case of multi-class: the same rater is used across classes
-            for idx_class in range(len(seg_pair_slice['gt'])):
-                seg_pair_slice['gt'][idx_class] = seg_pair_slice['gt'][idx_class][idx_rater]
-                seg_pair_slice['gt_metadata'][idx_class] = seg_pair_slice['gt_metadata'][idx_class][idx_rater]
+            idx_rater = random.randrange(len(seg_pair_slice['gt'][0]))
+            seg_pair_slice['gt'] = [gt[idx_rater] for gt in seg_pair_slice['gt']]
+            seg_pair_slice['gt_metadata'] = [metadata[idx_rater]
+                                             for metadata in seg_pair_slice['gt_metadata']]
 
         metadata_input = seg_pair_slice['input_metadata'] if seg_pair_slice['input_metadata'] is not None else []
         metadata_roi = roi_pair_slice['gt_metadata'] if roi_pair_slice['gt_metadata'] is not None else []
@@ -218,50 +326,45 @@ class MRI2DSegmentationDataset(Dataset):
             stack_gt, metadata_gt = self.transform(sample=seg_pair_slice["gt"],
                                                    metadata=metadata_gt,
                                                    data_type="gt")
-            # Make sure stack_gt is binarized
+            # Make sure stack_gt is binarized: threshold and cast in a single pass, the uint8
+            # output is 4x smaller than float32 when collated by the DataLoader
             if stack_gt is not None and not self.soft_gt:
-                stack_gt = imed_postpro.threshold_predictions(stack_gt, thr=0.5).astype(np.uint8)
+                if isinstance(stack_gt, torch.Tensor):
+                    stack_gt = stack_gt.ge_(0.5).to(torch.uint8)
+                else:
+                    stack_gt = (stack_gt >= 0.5).astype(np.uint8)
 
         else:
             # Force no transformation on labels for classification task
-            # stack_gt is a tensor of size 1x1, values: 0 or 1
-            # "expand(1)" is necessary to be compatible with segmentation convention: n_labelxhxwxd
-            stack_gt = torch.from_numpy(seg_pair_slice["gt"][0]).expand(1)
+            # stack_gt is a tensor of size 1, values: 0 or 1
+            # shape (1,) is necessary to be compatible with segmentation convention: n_labelxhxwxd
+            if self._labels is not None:
+                stack_gt = self._labels[index].reshape(1)
+            else:
+                stack_gt = torch.from_numpy(seg_pair_slice["gt"][0]).expand(1)
 
         # If is_2d_patch, add coordinates to metadata to reconstruct image
         if self.is_2d_patch:
-            shape_x = coord["x_max"] - coord["x_min"]
-            shape_y = coord["y_max"] - coord["y_min"]
-
             for metadata in metadata_input:
-                metadata['coord'] = [coord["x_min"], coord["x_max"], coord["y_min"], coord["y_max"]]
+                metadata['coord'] = [int(coord["x_min"]), int(coord["x_max"]),
+                                     int(coord["y_min"]), int(coord["y_max"])]
 
+            # One crop per tensor, shared across its channels
             data_dict = {
-                'input': torch.zeros(stack_input.shape[0], shape_x, shape_y),
-                'gt': torch.zeros(stack_gt.shape[0], shape_x, shape_y) if stack_gt is not None else None,
-                'roi': torch.zeros(stack_roi.shape[0], shape_x, shape_y) if stack_roi is not None else None,
+                'input': stack_input[:,
+                          coord['x_min']:coord['x_max'],
+                          coord['y_min']:coord['y_max']],
+                'gt': stack_gt[:,
+                       coord['x_min']:coord['x_max'],
+                       coord['y_min']:coord['y_max']] if stack_gt is not None else None,
+                'roi': stack_roi[:,
+                        coord['x_min']:coord['x_max'],
+                        coord['y_min']:coord['y_max']] if stack_roi is not None else None,
                 'input_metadata': metadata_input,
                 'gt_metadata': metadata_gt,
                 'roi_metadata': metadata_roi
             }
 
-            for _ in range(len(stack_input)):
-                data_dict['input'] = stack_input[:,
-                                      coord['x_min']:coord['x_max'],
-                                      coord['y_min']:coord['y_max']]
-
-            if stack_gt is not None:
-                for _ in range(len(stack_gt)):
-                    data_dict['gt'] = stack_gt[:,
-                                       coord['x_min']:coord['x_max'],
-                                       coord['y_min']:coord['y_max']]
-
-            if stack_roi is not None:
-                for _ in range(len(stack_roi)):
-                    data_dict['roi'] = stack_roi[:,
-                                       coord['x_min']:coord['x_max'],
-                                       coord['y_min']:coord['y_max']]
-
         else:
             data_dict = {
                 'input': stack_input,
@@ -1,3 +1,6 @@
+import hashlib
+import os
+import shutil
 from pathlib import Path
 import imageio
 import nibabel as nib
@@ -124,8 +127,75 @@ class SegmentationPair(object):
 
         return input_shape[0], gt_shape[0] if len(gt_shape) else None
 
+    def _cache_dir(self):
+        """Return the on-disk cache directory of this pair.
+
+        The key covers the filenames, the slice axis and the mtime/size of every source file,
+        so a regenerated volume (re-run preprocessing, corrected labels) misses the cache
+        instead of silently serving the stale data.
+        """
+        fnames = list(self.input_filenames)
+        for gt in self.gt_filenames or []:
+            if isinstance(gt, list):  # this tissue has annotation from several raters
+                fnames.extend(gt)
+            elif gt is not None:
+                fnames.append(gt)
+        stats = [(stat.st_mtime_ns, stat.st_size) for stat in map(os.stat, fnames)]
+        key = hashlib.blake2b(repr((self.input_filenames, self.gt_filenames, self.slice_axis,
+                                    stats)).encode(),
+                              digest_size=16).hexdigest()
+        return Path(os.environ["IVADOMED_CACHE"]) / key
+
+    def _read_cached_pair_data(self):
+        """Return the cached (input, ground truth) data upcast to float32, or None on miss.
+
+        The arrays are stored as fp16 but consumers (both the 2D slicer and the 3D subvolume
+        loader) expect float32, so the upcast happens here rather than downstream.
+        """
+        cache_dir = self._cache_dir()
+        if not cache_dir.is_dir():
+            return None
+        try:
+            input_data = [np.asarray(np.load(str(cache_dir / f"input_{idx}.npy"), mmap_mode='r'),
+                                     dtype=np.float32) for idx in range(len(self.input_handle))]
+            gt_data = [np.asarray(np.load(str(cache_dir / f"gt_{idx}.npy"), mmap_mode='r'),
+                                  dtype=np.float32) for idx in range(len(self.gt_handle))]
+        except (IOError, ValueError):
+            return None
+        return input_data, gt_data
+
+    def _write_cached_pair_data(self, input_data, gt_data):
+        """Store the decoded volumes as contiguous fp16 so later runs mmap them instead of re-decoding."""
+        # Multi-rater annotations keep a nested structure and are not cached
+        if any(isinstance(gt, list) for gt in gt_data):
+            return
+        cache_dir = self._cache_dir()
+        tmp_dir = cache_dir.with_name(f"{cache_dir.name}.tmp{os.getpid()}")
+        tmp_dir.mkdir(parents=True, exist_ok=True)
+        for idx, arr in enumerate(input_data):
+            np.save(str(tmp_dir / f"input_{idx}.npy"), np.ascontiguousarray(arr, dtype=np.float16))
+        for idx, arr in enumerate(gt_data):
+            np.save(str(tmp_dir / f"gt_{idx}.npy"), np.ascontiguousarray(arr, dtype=np.float16))
+        try:
+            os.replace(str(tmp_dir), str(cache_dir))
+        except OSError:
+            # Another process filled the cache first
+            shutil.rmtree(str(tmp_dir), ignore_errors=True)
+
     def get_pair_data(self):
-        """Return the tuple (input, ground truth) with the data content in numpy array."""
+        """Return the tuple (input, ground truth) with the data content in numpy array.
+
+        When the ``IVADOMED_CACHE`` environment variable points to a directory, the decoded and
+        oriented volumes are persisted there as fp16 ``.npy`` files and read back upcast to
+        float32 on later calls, so the NIfTI decompression runs only once across epochs and
+        processes.
+        """
+        use_disk_cache = "IVADOMED_CACHE" in os.environ
+        if use_disk_cache:
+            cached = self._read_cached_pair_data()
+            if cached is not None:
+                return cached
+
         cache_mode = 'fill' if self.cache else 'unchanged'
 
         input_data = []
@@ -152,6 +222,9 @@ class SegmentationPair(object):
                     np.zeros(imed_loader_utils.orient_shapes_hwd(self.input_handle[0].shape, self.slice_axis),
                              dtype=np.float32).astype(np.uint8))
 
+        if use_disk_cache:
+            self._write_cached_pair_data(input_data, gt_data)
+
         return input_data, gt_data
 
     def get_pair_metadata(self, slice_index=0, coord=None):
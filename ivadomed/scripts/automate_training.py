@@ -16,11 +16,14 @@ import copy
 import itertools
 from functools import partial
 import json
+import os
+import queue
 import random
 import collections.abc
 import shutil
 import sys
 import joblib
+import optuna
 import pandas as pd
 import numpy as np
 import torch.multiprocessing as mp
@@ -55,6 +58,13 @@ def get_parser():
                         help="To run all combinations of config"),
     parser.add_argument("-m", "--multi-params", dest="multi_params", action='store_true',
                         help="To change multiple parameters at once.")
+    parser.add_argument("--optuna", dest="optuna_search", action='store_true',
+                        help="""Run an Optuna TPE study over the hyperparameter options instead of
+                                training every configuration. Promising combinations are sampled
+                                first, so fewer trainings are needed to find the best config.""")
+    parser.add_argument("-nt", "--n-trials", dest="n_trials", default=10, type=int,
+                        help="Number of Optuna trials to run. Only used with the '--optuna' flag.",
+                        metavar=imed_utils.Metavar.int)
     parser.add_argument("--run-test", dest='run_test', action='store_true',
                         help="Evaluate the trained model on the testing sub-set.")
     parser.add_argument("--fixed-split", dest='fixed_split', action='store_true',
@@ -69,11 +79,32 @@ def get_parser():
                         metavar=imed_utils.Metavar.float)
     parser.add_argument("-o", "--output_dir", required=False,
                         help="Output Folder.")
+    parser.add_argument("--target-val", dest="target_val", required=False, type=float,
+                        help="""Stop the search as soon as a trained config reaches a
+                                best_validation_loss lower than or equal to this value. The
+                                remaining configs of the grid are skipped.""",
+                        metavar=imed_utils.Metavar.float)
 
     return parser
 
 
-def train_worker(config, thr_incr):
+def gpu_worker_init(gpu_queue):
+    """Bind a pool worker to a single GPU through ``CUDA_VISIBLE_DEVICES``.
+
+    Each worker pops one GPU id from the shared queue and makes it the only device visible to
+    the process, before any CUDA context is created. The workers therefore see their GPU as
+    device 0, which is why the configs trained in the pool use ``gpu_ids = [0]``.
+
+    Args:
+        gpu_queue (multiprocessing.Queue): Queue filled with the GPU ids listed in the config
+            file, one entry per pool worker.
+    """
+    gpu_id = gpu_queue.get()
+    os.environ["CUDA_VISIBLE_DEVICES"] = str(gpu_id)
+    logger.info(f"Worker {mp.current_process().name} bound to GPU {gpu_id}")
+
+
+def train_worker(config, thr_incr, stop_event=None, target_val=None):
     """
     Args:
         config (dict): dictionary containing configuration details.
@@ -81,13 +112,19 @@ def train_worker(config, thr_incr):
             using the trained model and the validation sub-dataset to find the optimal binarization
             threshold. The specified value indicates the increment between 0 and 1 used during the
             ROC analysis (e.g. 0.1). Flag: ``-t``, ``--thr-increment``
+        stop_event (multiprocessing.Event): Shared event set once a config has reached
+            ``target_val``. Workers return immediately when it is set.
+        target_val (float): If the best_validation_loss of this config is lower than or equal to
+            this value, ``stop_event`` is set so the remaining configs are skipped.
+            Flag: ``--target-val``
     """
-    current = mp.current_process()
-    # ID of process used to assign a GPU
-    ID = int(current.name[-1]) - 1
+    # Another config already reached the target: skip this training
+    if stop_event is not None and stop_event.is_set():
+        logger.info(f"Target best_validation_loss reached: skipping {config[ConfigKW.PATH_OUTPUT]}")
+        return None
 
-    # Use GPU i from the array specified in the config file
-    config[ConfigKW.GPU_IDS] = [config[ConfigKW.GPU_IDS][ID]]
+    # The worker is bound to a single GPU by gpu_worker_init, seen by the process as device 0
+    config[ConfigKW.GPU_IDS] = [0]
 
     # Call ivado cmd_train
     try:
@@ -105,6 +142,12 @@ def train_worker(config, thr_incr):
     config_copy = open(config[ConfigKW.PATH_OUTPUT] + "/config_file.json", "w")
     json.dump(config, config_copy, indent=4)
 
+    # Signal the other workers that the target has been reached
+    if stop_event is not None and target_val is not None and best_validation_loss <= target_val:
+        logger.info(f"Target best_validation_loss reached by {config[ConfigKW.PATH_OUTPUT]}: "
+                    f"{best_validation_loss} <= {target_val}")
+        stop_event.set()
+
     return config[ConfigKW.PATH_OUTPUT], best_training_dice, best_training_loss, best_validation_dice, \
         best_validation_loss
 
@@ -112,12 +155,8 @@ def train_worker(config, thr_incr):
 def test_worker(config):
     # Call ivado cmd_eval
 
-    current = mp.current_process()
-    # ID of process used to assign a GPU
-    ID = int(current.name[-1]) - 1
-
-    # Use GPU i from the array specified in the config file
-    config[ConfigKW.GPU_IDS] = [config[ConfigKW.GPU_IDS][ID]]
+    # The worker is bound to a single GPU by gpu_worker_init, seen by the process as device 0
+    config[ConfigKW.GPU_IDS] = [0]
 
     try:
         # Save best test score
@@ -184,6 +223,12 @@ def split_dataset(initial_config):
     return initial_config
 
 
+def get_folder_name_suffix(hyper_option_name):
+    """Turn a hyperparameter option name into a filesystem-friendly folder name suffix."""
+    suffix = hyper_option_name.translate({ord(i): None for i in '[]}{ \''})
+    return suffix.translate({ord(i): '-' for i in ':=,'})
+
+
 def make_config_list(param_list, initial_config, all_combin, multi_params):
     """Create a list of config dictionaries corresponding to different hyperparameters.
 
@@ -256,10 +301,7 @@ def make_config_list(param_list, initial_config, all_combin, multi_params):
                 path_output = new_config[ConfigKW.PATH_OUTPUT]
                 for hyper_option in combination:
                     new_config = update_dict(new_config, hyper_option.option, hyper_option.base_key)
-                    folder_name_suffix = hyper_option.name
-                    folder_name_suffix = folder_name_suffix.translate({ord(i): None for i in '[]}{ \''})
-                    folder_name_suffix = folder_name_suffix.translate({ord(i): '-' for i in ':=,'})
-                    path_output = path_output + folder_name_suffix
+                    path_output = path_output + get_folder_name_suffix(hyper_option.name)
                 new_config[ConfigKW.PATH_OUTPUT] = path_output
                 config_list.append(new_config)
     elif multi_params:
@@ -274,25 +316,102 @@ def make_config_list(param_list, initial_config, all_combin, multi_params):
             for key in base_key_dict.keys():
                 hyper_option = base_key_dict[key][i]
                 new_config = update_dict(new_config, hyper_option.option, hyper_option.base_key)
-                folder_name_suffix = hyper_option.name
-                folder_name_suffix = folder_name_suffix.translate({ord(i): None for i in '[]}{ \''})
-                folder_name_suffix = folder_name_suffix.translate({ord(i): '-' for i in ':=,'})
-                path_output = path_output + folder_name_suffix
+                path_output = path_output + get_folder_name_suffix(hyper_option.name)
             new_config[ConfigKW.PATH_OUTPUT] = path_output
             config_list.append(new_config)
     else:
         for hyper_option in param_list:
             new_config = copy.deepcopy(initial_config)
             update_dict(new_config, hyper_option.option, hyper_option.base_key)
-            folder_name_suffix = hyper_option.name
-            folder_name_suffix = folder_name_suffix.translate({ord(i): None for i in '[]}{ \''})
-            folder_name_suffix = folder_name_suffix.translate({ord(i): '-' for i in ':=,'})
-            new_config[ConfigKW.PATH_OUTPUT] = initial_config[ConfigKW.PATH_OUTPUT] + folder_name_suffix
+            new_config[ConfigKW.PATH_OUTPUT] = initial_config[ConfigKW.PATH_OUTPUT] + \
+                get_folder_name_suffix(hyper_option.name)
             config_list.append(new_config)
 
     return config_list
 
 
+def optuna_training(param_list, initial_config, n_trials, thr_increment=None, output_dir=""):
+    """Search the hyperparameter options with an Optuna TPE study instead of an exhaustive run.
+
+    One hyperparameter option is sampled per ``base_key`` at each trial, the corresponding
+    config is trained, and ``best_validation_loss`` is reported back to the study so the TPE
+    sampler concentrates the remaining trials on promising regions of the search space.
+    Trials are dispatched on the GPUs listed in ``gpu_ids``, one trial per GPU at a time.
+
+    Args:
+        param_list (list)(HyperparameterOption): A list of the different hyperparameter options.
+        initial_config (dict): The original config file, which we use as a basis from which
+            to modify our hyperparameters.
+        n_trials (int): Number of trials to run. Flag: ``--n-trials``, ``-nt``
+        thr_increment (float): A threshold analysis is performed at the end of the training
+            using the trained model and the validation sub-dataset to find the optimal
+            binarization threshold. The specified value indicates the increment between 0 and 1
+            used during the ROC analysis (e.g. 0.1). Flag: ``-t``, ``--thr-increment``
+        output_dir (str): Path to where the results will be saved.
+
+    Returns:
+        pd.DataFrame: Dataframe of all the trials, as returned by ``study.trials_dataframe()``.
+    """
+    base_key_dict = {key: [] for key in get_base_keys(param_list)}
+    for hyper_option in param_list:
+        base_key_dict[hyper_option.base_key].append(hyper_option)
+
+    # One trial per GPU at a time: each trial takes a GPU id from the queue and puts it back
+    # once the training is done.
+    gpu_ids = initial_config[ConfigKW.GPU_IDS]
+    gpu_queue = queue.Queue()
+    for gpu_id in gpu_ids:
+        gpu_queue.put(gpu_id)
+
+    def objective(trial):
+        config = copy.deepcopy(initial_config)
+        path_output = config[ConfigKW.PATH_OUTPUT]
+        for base_key, hyper_options in base_key_dict.items():
+            idx = trial.suggest_categorical(base_key, list(range(len(hyper_options))))
+            hyper_option = hyper_options[idx]
+            config = update_dict(config, hyper_option.option, base_key)
+            path_output = path_output + get_folder_name_suffix(hyper_option.name)
+
+        # The sampler draws categorical combinations with replacement: return the recorded
+        # value of an already-trained combination instead of retraining it
+        for prev_trial in trial.study.get_trials(deepcopy=False,
+                                                 states=(optuna.trial.TrialState.COMPLETE,)):
+            if prev_trial.params == trial.params:
+                return prev_trial.value
+
+        # Suffix with the trial number so concurrent trials that sampled the same combination
+        # do not train into the same directory
+        config[ConfigKW.PATH_OUTPUT] = path_output + "_trial" + str(trial.number)
+
+        gpu_id = gpu_queue.get()
+        try:
+            config[ConfigKW.GPU_IDS] = [gpu_id]
+            config[ConfigKW.COMMAND] = "train"
+            best_training_dice, best_training_loss, best_validation_dice, best_validation_loss = \
+                ivado.run_command(config, thr_increment=thr_increment)
+        finally:
+            gpu_queue.put(gpu_id)
+
+        # Save config file in output path
+        with open(config[ConfigKW.PATH_OUTPUT] + "/config_file.json", "w") as config_copy:
+            json.dump(config, config_copy, indent=4)
+
+        return best_validation_loss
+
+    # No pruner: the objective only reports the final validation loss, there are no
+    # intermediate values a pruner could act on
+    study = optuna.create_study(direction="minimize",
+                                sampler=optuna.samplers.TPESampler())
+    study.optimize(objective, n_trials=n_trials, n_jobs=len(gpu_ids))
+
+    logger.info(f"Best trial: {study.best_trial.number}, "
+                f"best_validation_loss: {study.best_value}")
+
+    results_df = study.trials_dataframe()
+    results_df.to_csv(str(Path(output_dir, "optuna_results.csv")))
+    return results_df
+
+
 class HyperparameterOption:
     """Hyperparameter option to edit config dictionary.
 
@@ -470,10 +589,12 @@ def get_base_keys(hyperparam_list):
 def format_results(results_df, config_list, param_list):
     """Merge config and results in a df."""
 
-    config_df = pd.DataFrame.from_dict(config_list)
+    # Build only the hyperparameter columns: a dataframe over the full config dicts would
+    # allocate (and type-infer) dozens of columns that are immediately discarded
     keep = list(set([list(hyper_option.option.keys())[0] for hyper_option in param_list]))
     keep.append(ConfigKW.PATH_OUTPUT)
-    config_df = config_df[keep]
+    config_df = pd.DataFrame([{key: config[key] for key in keep} for config in config_list],
+                             columns=keep)
 
     results_df = config_df.set_index(ConfigKW.PATH_OUTPUT).join(results_df.set_index(ConfigKW.PATH_OUTPUT))
     results_df = results_df.reset_index()
@@ -483,7 +604,8 @@ def format_results(results_df, config_list, param_list):
 
 def automate_training(file_config, file_config_hyper, fixed_split, all_combin, path_data=None,
                       n_iterations=1, run_test=False, all_logs=False, thr_increment=None,
-                      multi_params=False, output_dir=None, plot_comparison=False):
+                      multi_params=False, output_dir=None, plot_comparison=False,
+                      optuna_search=False, n_trials=10, target_val=None):
     """Automate multiple training processes on multiple GPUs.
 
     Hyperparameter optimization of models is tedious and time-consuming. This function automatizes
@@ -664,6 +786,13 @@ def automate_training(file_config, file_config_hyper, fixed_split, all_combin, p
             the hyperparameters. All the first elements from the hyperparameters list will be
             applied, then all the second, etc.
         output_dir (str): Path to where the results will be saved.
+        optuna_search (bool): If True, the hyperparameter options are explored with an Optuna
+            TPE study rather than by training every configuration. Flag: ``--optuna``
+        n_trials (int): Number of Optuna trials. Only used when ``optuna_search`` is True.
+            Flag: ``--n-trials``, ``-nt``
+        target_val (float): If not None, the search is early-stopped: as soon as a config
+            reaches a best_validation_loss lower than or equal to this value, the configs
+            that have not started training yet are skipped. Flag: ``--target-val``
     """
     if output_dir and not Path(output_dir).exists():
         Path(output_dir).mkdir(parents=True)
@@ -685,20 +814,38 @@ def automate_training(file_config, file_config_hyper, fixed_split, all_combin, p
         config_hyper = json.load(fhandle)
 
     param_list = get_param_list(config_hyper, [], [])
+
+    if optuna_search:
+        results_df = optuna_training(param_list, initial_config, n_trials,
+                                     thr_increment=thr_increment, output_dir=output_dir)
+        logger.info("Detailed results")
+        logger.info(results_df)
+        return
+
     config_list = make_config_list(param_list, initial_config, all_combin, multi_params)
 
     # CUDA problem when forking process
     # https://github.com/pytorch/pytorch/issues/2517
     ctx = mp.get_context("spawn")
 
+    # Shared event used to early-stop the search once a config reaches the target
+    stop_event = ctx.Manager().Event() if target_val is not None else None
+
     # Run all configs on a separate process, with a maximum of n_gpus  processes at a given time
     logger.info(initial_config[ConfigKW.GPU_IDS])
 
+    # Each worker pops one GPU id from the queue in its initializer and is bound to it via
+    # CUDA_VISIBLE_DEVICES for its whole lifetime
+    gpu_queue = ctx.Queue()
+    for gpu_id in initial_config[ConfigKW.GPU_IDS]:
+        gpu_queue.put(gpu_id)
+
     results_df = pd.DataFrame()
     eval_df = pd.DataFrame()
     all_mean = pd.DataFrame()
 
-    with ctx.Pool(processes=len(initial_config[ConfigKW.GPU_IDS])) as pool:
+    with ctx.Pool(processes=len(initial_config[ConfigKW.GPU_IDS]),
+                  initializer=gpu_worker_init, initargs=(gpu_queue,)) as pool:
         for i in range(n_iterations):
             if not fixed_split:
                 # Set seed for iteration
@@ -712,15 +859,25 @@ def automate_training(file_config, file_config_hyper, fixed_split, all_combin, p
                         else:
                             config[ConfigKW.PATH_OUTPUT] += "_n=" + str(i).zfill(2)
 
-                validation_scores = pool.map(partial(train_worker, thr_incr=thr_increment), config_list)
+                # imap_unordered streams results back as trainings finish, so the early-stop
+                # event set by a worker is honored by the configs still waiting in the queue
+                validation_scores = [score for score in
+                                     pool.imap_unordered(partial(train_worker, thr_incr=thr_increment,
+                                                                 stop_event=stop_event, target_val=target_val),
+                                                         config_list)
+                                     if score is not None]
 
             val_df = pd.DataFrame(validation_scores, columns=[
                 'path_output', 'best_training_dice', 'best_training_loss', 'best_validation_dice',
                 'best_validation_loss'])
 
             if run_test:
+                trained_paths = set(val_df['path_output'])
                 new_config_list = []
                 for config in config_list:
+                    # Skip configs whose training was early-stopped
+                    if config[ConfigKW.PATH_OUTPUT] not in trained_paths:
+                        continue
                     # Delete path_pred
                     path_pred = Path(config['path_output'], 'pred_masks')
                     if path_pred.is_dir() and n_iterations > 1:
@@ -808,7 +965,10 @@ def main(args=None):
                       all_logs=args.all_logs,
                       thr_increment=thr_increment,
                       multi_params=bool(args.multi_params),
-                      output_dir=args.output_dir
+                      output_dir=args.output_dir,
+                      optuna_search=bool(args.optuna_search),
+                      n_trials=int(args.n_trials),
+                      target_val=args.target_val
                       )
 
 
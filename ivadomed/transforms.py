@@ -7,11 +7,8 @@ import random
 import numpy as np
 import torch
 from loguru import logger
-from scipy.ndimage import zoom
-from scipy.ndimage.filters import gaussian_filter
-from scipy.ndimage.interpolation import map_coordinates, affine_transform
-from scipy.ndimage.measurements import label, center_of_mass
-from scipy.ndimage.morphology import binary_dilation, binary_fill_holes, binary_closing
+from scipy.ndimage import zoom, gaussian_filter, map_coordinates, affine_transform, label, \
+    binary_fill_holes, binary_closing, distance_transform_cdt
 from skimage.exposure import equalize_adapthist
 from torchvision import transforms as torchvision_transforms
 
@@ -482,8 +479,10 @@ class ROICrop(Crop):
         # If crop_params are not in metadata,
         # then we are here dealing with ROI data to determine crop params
         if self.__class__.__name__ not in metadata['crop_params']:
-            # Compute center of mass of the ROI
-            h_roi, w_roi, d_roi = center_of_mass(sample.astype(np.int))
+            # Compute center of mass of the ROI: for the binary ROI masks this is the
+            # coordinate mean of the nonzero voxels, which avoids materializing the full int64
+            # copy and the generic scipy path of center_of_mass
+            h_roi, w_roi, d_roi = np.argwhere(sample.astype(np.uint8)).mean(axis=0)
             h_roi, w_roi, d_roi = int(round(h_roi)), int(round(w_roi)), int(round(d_roi))
             th, tw, td = self.size
             th_half, tw_half, td_half = int(round(th / 2.)), int(round(tw / 2.)), int(round(td / 2.))
@@ -502,6 +501,59 @@ class ROICrop(Crop):
         return super().__call__(sample, metadata)
 
 
+# full-connectivity structures of DilateGT (8-connectivity in-plane), built once and passed
+# explicitly so labeling and closing agree on what a lesion is; 2D samples come in as (h, w, 1)
+_FULL_STRUCT_2D = np.ones((3, 3, 1), dtype=bool)
+_FULL_STRUCT_3D = np.ones((3, 3, 3), dtype=bool)
+
+
+def _soft_dilate(arr_bin, dil_factor, arr_labeled=None, dist=None):
+    """Numerical core of :class:`DilateGT`: soft-dilate a binary mask in one vectorized pass.
+
+    Operates on compact dtypes (uint8 mask in, float32 soft / uint8 binary mask out) so the
+    DataLoader workers running it touch as few bytes as possible.
+
+    Args:
+        arr_bin (ndarray): Binary mask, uint8.
+        dil_factor (float): Controls the number of dilation iterations of each object, computed
+            as ``int(round(dil_factor * sqrt(object_area)))``.
+        arr_labeled (ndarray): Optional int32 scratch buffer for the label image.
+        dist (ndarray): Optional int32 scratch buffer for the distance image.
+
+    Returns:
+        ndarray, ndarray: Soft mask (float32), binary mask of its support (uint8).
+    """
+    # identify each object, with the same full connectivity as the post-processing closing
+    # (label requires a 3x3x3 structure; a single-slice last axis has no neighbors anyway)
+    if arr_labeled is None:
+        arr_labeled = np.empty(arr_bin.shape, dtype=np.int32)
+    lb_nb = label(arr_bin, structure=_FULL_STRUCT_3D, output=arr_labeled)
+
+    if not lb_nb:
+        return arr_bin.astype(np.float32), arr_bin
+
+    # number of dilation iterations of each object, from its size
+    sizes = np.bincount(arr_labeled.ravel())
+    nb_it_lut = np.round(dil_factor * np.sqrt(sizes)).astype(np.int32)
+    nb_it_lut[0] = 0
+
+    # taxicab distance to the nearest object and its label, in a single pass: the voxels at
+    # distance k from an object are exactly its k-th 1-iteration binary_dilation shell, so
+    # the per-object loop of sequential dilations is replaced by one distance transform
+    if dist is None:
+        dist = np.empty(arr_bin.shape, dtype=np.int32)
+    indices = distance_transform_cdt(arr_labeled == 0, metric='taxicab',
+                                     return_indices=True, distances=dist)
+    nb_it_map = nb_it_lut[arr_labeled[tuple(indices)]]
+
+    # assign a soft value (]0, 1]) decreasing with the distance: the k-th shell of an object
+    # dilated nb_it times gets (nb_it - k + 1) / (nb_it + 1), the object itself stays at 1
+    arr_soft = np.clip(1.0 - dist / (nb_it_map + 1.0), 0.0, 1.0).astype(np.float32)
+    arr_bin_out = (arr_soft > 0).astype(np.uint8)
+
+    return arr_soft, arr_bin_out
+
+
 class DilateGT(ImedTransform):
     """Randomly dilate a ground-truth tensor.
 
@@ -518,86 +570,60 @@ class DilateGT(ImedTransform):
 
     def __init__(self, dilation_factor):
         self.dil_factor = dilation_factor
-
-    @staticmethod
-    def dilate_lesion(arr_bin, arr_soft, label_values):
-        for lb in label_values:
-            # binary dilation with 1 iteration
-            arr_dilated = binary_dilation(arr_bin, iterations=1)
-
-            # isolate new voxels, i.e. the ones from the dilation
-            new_voxels = np.logical_xor(arr_dilated, arr_bin).astype(np.int)
-
-            # assign a soft value (]0, 1[) to the new voxels
-            soft_new_voxels = lb * new_voxels
-
-            # add the new voxels to the input mask
-            arr_soft += soft_new_voxels
-            arr_bin = (arr_soft > 0).astype(np.int)
-
-        return arr_bin, arr_soft
+        # per-shape scratch buffers for the label and distance intermediates, reused across
+        # calls so each sample does not go through the allocator again
+        self._scratch = {}
+
+    def _buf(self, name, shape, dtype):
+        """Return a cached scratch buffer, reallocated only when the sample shape changes."""
+        key = (name, shape, np.dtype(dtype))
+        if key not in self._scratch:
+            self._scratch = {k: v for k, v in self._scratch.items() if k[0] != name}
+            self._scratch[key] = np.empty(shape, dtype=dtype)
+        return self._scratch[key]
 
     def dilate_arr(self, arr, dil_factor):
-        # identify each object
-        arr_labeled, lb_nb = label(arr.astype(np.int))
-
-        # loop across each object
-        arr_bin_lst, arr_soft_lst = [], []
-        for obj_idx in range(1, lb_nb + 1):
-            arr_bin_obj = (arr_labeled == obj_idx).astype(np.int)
-            arr_soft_obj = np.copy(arr_bin_obj).astype(np.float)
-            # compute the number of dilation iterations depending on the size of the lesion
-            nb_it = int(round(dil_factor * math.sqrt(arr_bin_obj.sum())))
-            # values of the voxels added to the input mask
-            soft_label_values = [x / (nb_it + 1) for x in range(nb_it, 0, -1)]
-            # dilate lesion
-            arr_bin_dil, arr_soft_dil = self.dilate_lesion(arr_bin_obj, arr_soft_obj, soft_label_values)
-            arr_bin_lst.append(arr_bin_dil)
-            arr_soft_lst.append(arr_soft_dil)
-
-        # sum dilated objects
-        arr_bin_idx = np.sum(np.array(arr_bin_lst), axis=0)
-        arr_soft_idx = np.sum(np.array(arr_soft_lst), axis=0)
-        # clip values in case dilated voxels overlap
-        arr_bin_clip, arr_soft_clip = np.clip(arr_bin_idx, 0, 1), np.clip(arr_soft_idx, 0.0, 1.0)
-
-        return arr_soft_clip.astype(np.float), arr_bin_clip.astype(np.int)
+        arr_bin = arr.astype(np.uint8)
+        return _soft_dilate(arr_bin, dil_factor,
+                            arr_labeled=self._buf('labeled', arr_bin.shape, np.int32),
+                            dist=self._buf('dist', arr_bin.shape, np.int32))
 
     @staticmethod
     def random_holes(arr_in, arr_soft, arr_bin):
         arr_soft_out = np.copy(arr_soft)
 
-        # coordinates of the new voxels, i.e. the ones from the dilation
-        new_voxels_xx, new_voxels_yy, new_voxels_zz = np.where(np.logical_xor(arr_bin, arr_in))
-        nb_new_voxels = new_voxels_xx.shape[0]
+        # the new voxels, i.e. the ones from the dilation; on 0/1 masks the inequality is the
+        # XOR, computed as one pass straight to bool
+        new_voxels = arr_bin != arr_in
 
         # ratio of voxels added to the input mask from the dilated mask
         new_voxel_ratio = random.random()
-        # randomly select new voxel indexes to remove
-        idx_to_remove = random.sample(range(nb_new_voxels),
-                                      int(round(nb_new_voxels * (1 - new_voxel_ratio))))
-
-        # set to zero the here-above randomly selected new voxels
-        arr_soft_out[new_voxels_xx[idx_to_remove],
-                     new_voxels_yy[idx_to_remove],
-                     new_voxels_zz[idx_to_remove]] = 0.0
-        arr_bin_out = (arr_soft_out > 0).astype(np.int)
+        # each new voxel is kept with probability new_voxel_ratio: one vectorized draw
+        # replaces the Python-level random.sample of the indexes to remove and the scattered
+        # fancy-indexed writes
+        drop = new_voxels & (np.random.rand(*arr_soft_out.shape) >= new_voxel_ratio)
+        arr_soft_out[drop] = 0.0
+        arr_bin_out = (arr_soft_out > 0).astype(np.uint8)
 
         return arr_soft_out, arr_bin_out
 
     @staticmethod
     def post_processing(arr_in, arr_soft, arr_bin, arr_dil):
         # remove new object that are not connected to the input mask
-        arr_labeled, lb_nb = label(arr_bin)
+        arr_labeled, lb_nb = label(arr_bin, structure=_FULL_STRUCT_3D)
 
+        # keep the labels overlapping the input mask: one O(n) bincount builds the keep LUT,
+        # one gather applies it
         connected_to_in = arr_labeled * arr_in
-        for lb in range(1, lb_nb + 1):
-            if np.sum(connected_to_in == lb) == 0:
-                arr_soft[arr_labeled == lb] = 0
-
-        struct = np.ones((3, 3, 1) if arr_soft.shape[2] == 1 else (3, 3, 3))
-        # binary closing
-        arr_bin_closed = binary_closing((arr_soft > 0).astype(np.int), structure=struct)
+        keep = np.bincount(connected_to_in.ravel().astype(np.intp), minlength=lb_nb + 1) > 0
+        keep[0] = True
+        arr_soft = arr_soft * keep[arr_labeled]
+
+        # binary closing; operate on the contiguous bool mask directly, the int64 cast only
+        # added memory traffic since the morphology routines binarize their input anyway
+        arr_bin_closed = binary_closing(arr_soft > 0,
+                                        structure=_FULL_STRUCT_2D if arr_soft.shape[2] == 1
+                                        else _FULL_STRUCT_3D)
         # fill binary holes
         arr_bin_filled = binary_fill_holes(arr_bin_closed)
 
@@ -610,7 +636,7 @@ class DilateGT(ImedTransform):
     @two_dim_compatible
     def __call__(self, sample, metadata=None):
         # binarize for processing
-        gt_data_np = (sample > 0.5).astype(np.int_)
+        gt_data_np = (sample > 0.5).astype(np.uint8)
 
         if self.dil_factor > 0 and np.sum(sample):
             # dilation
@@ -623,7 +649,8 @@ class DilateGT(ImedTransform):
             # gt_pp = self.post_processing(gt_data_np, gt_holes, gt_holes_bin, gt_dil)
 
             # return gt_pp.astype(np.float32), metadata
-            return gt_dil.astype(np.float32), metadata
+            # the soft mask is already a contiguous float32 array, return it without a copy
+            return gt_dil, metadata
 
         else:
             return sample, metadata
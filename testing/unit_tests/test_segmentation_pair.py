@@ -0,0 +1,59 @@
+import os
+
+import nibabel as nib
+import numpy as np
+from pathlib import Path
+import logging
+
+from ivadomed.loader.segmentation_pair import SegmentationPair
+from testing.unit_tests.t_utils import create_tmp_dir, __tmp_dir__
+from testing.common_testing_util import remove_tmp_dir
+
+logger = logging.getLogger(__name__)
+
+
+def setup_function():
+    create_tmp_dir(copy_data_testing_dir=False)
+
+
+def _save_nifti(data, fname):
+    path = str(Path(__tmp_dir__, fname))
+    nib.save(nib.Nifti1Image(data, np.eye(4)), path)
+    return path
+
+
+def test_disk_cache_round_trip(monkeypatch):
+    rng = np.random.RandomState(42)
+    fname_input = _save_nifti(rng.rand(8, 9, 4).astype(np.float32), 'input.nii.gz')
+    fname_gt = _save_nifti((rng.rand(8, 9, 4) > 0.5).astype(np.float32), 'gt.nii.gz')
+    monkeypatch.setenv("IVADOMED_CACHE", str(Path(__tmp_dir__, 'cache')))
+
+    # First call decodes the NIfTI files and fills the cache, second call reads it back
+    input_fresh, gt_fresh = SegmentationPair([fname_input], [fname_gt]).get_pair_data()
+    input_cached, gt_cached = SegmentationPair([fname_input], [fname_gt]).get_pair_data()
+
+    for fresh, cached in zip(input_fresh + gt_fresh, input_cached + gt_cached):
+        # Cached volumes are stored as fp16 but must come back as float32, also for the
+        # 3D subvolume loader which consumes get_pair_data output directly
+        assert cached.dtype == np.float32
+        assert np.allclose(cached, fresh, atol=1e-3)
+
+
+def test_disk_cache_invalidated_on_file_change(monkeypatch):
+    rng = np.random.RandomState(42)
+    fname_input = _save_nifti(rng.rand(8, 9, 4).astype(np.float32), 'input.nii.gz')
+    fname_gt = _save_nifti((rng.rand(8, 9, 4) > 0.5).astype(np.float32), 'gt.nii.gz')
+    monkeypatch.setenv("IVADOMED_CACHE", str(Path(__tmp_dir__, 'cache')))
+
+    SegmentationPair([fname_input], [fname_gt]).get_pair_data()
+
+    # Regenerate the input volume, as a re-run preprocessing would
+    new_data = rng.rand(8, 9, 4).astype(np.float32)
+    os.utime(_save_nifti(new_data, 'input.nii.gz'), ns=(0, 0))
+
+    input_reloaded, _ = SegmentationPair([fname_input], [fname_gt]).get_pair_data()
+    assert np.allclose(input_reloaded[0], new_data, atol=1e-3)
+
+
+def teardown_function():
+    remove_tmp_dir()